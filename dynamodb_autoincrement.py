@@ -3,11 +3,19 @@
 # All Rights Reserved.
 
 import asyncio
+import inspect
+import random
+import time
+import uuid
+import weakref
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from copy import deepcopy
+from dataclasses import dataclass, field
 from typing import Any, Iterable, Optional, Mapping, Sequence, Union
 from decimal import Decimal
 
+from aioboto3 import Session
+from aiobotocore.config import AioConfig
 from types_aiobotocore_dynamodb.service_resource import DynamoDBServiceResource
 
 # FIXME: remove instances of 'type: ignore[attr-defined]' below once
@@ -22,6 +30,92 @@ DynamoDBValues = Union[
 ]
 DynamoDBItem = Mapping[str, DynamoDBValues]
 
+# Transaction cancellation reasons for the counter put that indicate that
+# someone else updated the counter first
+RETRYABLE_CANCELLATION_CODES = frozenset(
+    {"ConditionalCheckFailed", "TransactionConflict"}
+)
+
+# boto3 returns numbers as Decimal, so do counter arithmetic in Decimal too
+ONE = Decimal(1)
+
+# The maximum number of actions and the maximum total size of the items in a
+# single TransactWriteItems request
+MAX_TRANSACT_ITEMS = 100
+MAX_TRANSACT_SIZE = 4 * 1024 * 1024
+
+
+def item_size(value) -> int:
+    # An upper bound on the size that DynamoDB counts for a value, following
+    # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/CapacityUnitCalculations.html
+    if isinstance(value, str):
+        return len(value.encode())
+    elif isinstance(value, (bytes, bytearray)) or hasattr(value, "__bytes__"):
+        # The last case is boto3.dynamodb.types.Binary
+        return len(bytes(value))
+    elif isinstance(value, bool) or value is None:
+        return 1
+    elif isinstance(value, (int, float, Decimal)):
+        return 21
+    elif isinstance(value, Mapping):
+        return 3 + sum(
+            len(key.encode()) + 1 + item_size(item) for key, item in value.items()
+        )
+    elif isinstance(value, (set, frozenset)):
+        return sum(item_size(item) for item in value)
+    else:
+        return 3 + sum(1 + item_size(item) for item in value)
+
+
+def is_retryable(e) -> bool:
+    # The counter put is always the first item in the transaction. Any other
+    # failure will not go away by retrying. In particular, a failed condition
+    # on the data put alone means that the ID was already taken by an item that
+    # was written without going through the counter.
+    reasons = e.response.get("CancellationReasons", [])
+    return bool(reasons) and reasons[0].get("Code") in RETRYABLE_CANCELLATION_CODES
+
+
+def backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    # Capped exponential backoff with full jitter
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+# The locks for local_serialize, by event loop and then by counter, so that
+# every instance that uses the same counter in the same event loop shares one.
+# Puts hold on to the lock while they use it, so the lock for a counter goes
+# away once no put is using it.
+local_locks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def local_lock(counter_table_name: str, counter_table_key: DynamoDBItem):
+    locks = local_locks.setdefault(
+        asyncio.get_running_loop(), weakref.WeakValueDictionary()
+    )
+    key = (counter_table_name, frozenset(counter_table_key.items()))
+    try:
+        return locks[key]
+    except KeyError:
+        lock = locks[key] = asyncio.Lock()
+        return lock
+
+
+async def gather_or_cancel(*aws):
+    # Like asyncio.gather, but cancel the rest as soon as one fails. (This is
+    # what asyncio.TaskGroup does, but that requires Python 3.11 and raises an
+    # ExceptionGroup instead of the original exception.)
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+    for task in tasks:
+        if not task.cancelled() and (e := task.exception()) is not None:
+            raise e
+    return [task.result() for task in tasks]
+
 
 @dataclass(frozen=True)
 class BaseDynamoDBAutoIncrement(ABC):
@@ -32,101 +126,316 @@ class BaseDynamoDBAutoIncrement(ABC):
     table_name: str
     initial_value: int
     dangerously: bool = False
+    max_attempts: int = 10
+    base_delay: float = 0.05
+    max_delay: float = 2.0
+    read_dynamodb: Optional[DynamoDBServiceResource] = None
+    local_serialize: bool = True
+
+    def __post_init__(self):
+        object.__setattr__(self, "_initial_value", Decimal(self.initial_value))
+        # The counter value written by our last successful transaction. If no
+        # one else has touched the counter since, then we can skip reading it.
+        object.__setattr__(self, "_last_counter", None)
+        object.__setattr__(
+            self,
+            "_TransactionCanceledException",
+            self.dynamodb.meta.client.exceptions.TransactionCanceledException,
+        )
+        # The parts of the counter and data puts that are the same every time.
+        # boto3 copies request parameters before serializing them, so it is
+        # safe to share these between requests.
+        counter_ean = {"#counter": self.attribute_name}
+        object.__setattr__(
+            self,
+            "_counter_put_template",
+            {
+                "ExpressionAttributeNames": counter_ean,
+                "TableName": self.counter_table_name,
+            },
+        )
+        object.__setattr__(
+            self,
+            "_data_put_template",
+            {
+                "ConditionExpression": "attribute_not_exists(#counter)",
+                "ExpressionAttributeNames": counter_ean,
+                "TableName": self.table_name,
+            },
+        )
+
+    @classmethod
+    def make_resource(
+        cls, session: Session, config: Optional[AioConfig] = None, **kwargs
+    ):
+        # Enough pooled, kept-alive connections that many concurrent puts do
+        # not queue for a socket or pay for a new TLS handshake.
+        default_config = AioConfig(
+            connector_args={"keepalive_timeout": 75},
+            max_pool_connections=64,
+            tcp_keepalive=True,
+            retries={"mode": "adaptive", "max_attempts": 10},
+        )
+        if config is not None:
+            # AioConfig.merge keeps only our connector_args, and AioConfig
+            # fills in defaults for any that are missing, so only override
+            # the ones that the caller set to something other than a default.
+            defaults = AioConfig().connector_args  # type: ignore[attr-defined]
+            connector_args = {
+                key: value
+                for key, value in config.connector_args.items()  # type: ignore[attr-defined]
+                if key not in defaults or defaults[key] != value
+            }
+            default_config = default_config.merge(config)
+            default_config.connector_args.update(connector_args)  # type: ignore[attr-defined]
+        return session.resource("dynamodb", config=default_config, **kwargs)
 
     @abstractmethod
-    async def next(self, item: DynamoDBItem) -> tuple[Iterable[dict[str, Any]], str]:
+    async def next(
+        self, item: DynamoDBItem
+    ) -> tuple[tuple[dict[str, Any], ...], Union[int, Decimal]]:
         raise NotImplementedError
 
     async def put(self, item: DynamoDBItem):
-        TransactionCanceledException = (
-            self.dynamodb.meta.client.exceptions.TransactionCanceledException
-        )
+        return await self._put(self.next, item)
+
+    async def _put(self, next, arg):
+        if not self.local_serialize:
+            return await self._put_with_retries(next, arg)
+        # Puts from this process would only contend with each other for the
+        # counter, so take turns rather than racing and retrying.
+        async with local_lock(self.counter_table_name, self.counter_table_key):
+            return await self._put_with_retries(next, arg)
+
+    async def _put_with_retries(self, next, arg):
+        attempt = 0
+        consistent = False
         while True:
-            puts, next_counter = await self.next(item)
+            guessed = not consistent and (
+                self._cached_counter() is not None or self.read_dynamodb is not None
+            )
+            # Subclasses that predate the consistent argument do not take it
+            if consistent and "consistent" in inspect.signature(next).parameters:
+                puts, result = await next(arg, consistent=True)
+            else:
+                puts, result = await next(arg)
             if self.dangerously:
-                await asyncio.gather(*(self.dynamodb.put_item(**put) for put in puts))  # type: ignore[attr-defined]
+                await gather_or_cancel(*(self.dynamodb.put_item(**put) for put in puts))  # type: ignore[attr-defined]
             else:
                 try:
+                    # botocore retries network errors by resending the request
+                    # with the same token. If an earlier attempt succeeded but
+                    # we lost the response, then DynamoDB treats the retry as a
+                    # no-op rather than writing the item twice.
                     await self.dynamodb.transact_write_items(  # type: ignore[attr-defined]
-                        TransactItems=[{"Put": put} for put in puts]
+                        TransactItems=[{"Put": put} for put in puts],
+                        ClientRequestToken=uuid.uuid4().hex,
+                    )
+                except self._TransactionCanceledException as e:
+                    object.__setattr__(self, "_last_counter", None)
+                    if not is_retryable(e):
+                        raise
+                    # A cache may keep serving the old counter value for a
+                    # while, so from now on read it from the table itself.
+                    consistent = True
+                    if guessed:
+                        # Our cached counter was out of date, most likely
+                        # because another process put an item since our last
+                        # put. That is not contention, so read the counter and
+                        # try again right away.
+                        continue
+                    attempt += 1
+                    if attempt >= self.max_attempts:
+                        raise
+                    await asyncio.sleep(
+                        backoff(attempt, self.base_delay, self.max_delay)
                     )
-                except TransactionCanceledException:
                     continue
-            return next_counter
+                # The first put is always the one that updates the counter.
+                object.__setattr__(
+                    self, "_last_counter", puts[0]["Item"][self.attribute_name]
+                )
+            return result
+
+    def _cached_counter(self):
+        # The counter value that next() will use without reading it, if any
+        return None
+
+    async def _get_counter_item(self, consistent, **kwargs):
+        if consistent:
+            return await self.dynamodb.get_item(ConsistentRead=True, **kwargs)  # type: ignore[attr-defined]
+        else:
+            return await (self.read_dynamodb or self.dynamodb).get_item(**kwargs)  # type: ignore[attr-defined]
 
 
 class DynamoDBAutoIncrement(BaseDynamoDBAutoIncrement):
-    async def next(self, item):
-        counter = (
-            (
-                await self.dynamodb.get_item(
-                    AttributesToGet=[self.attribute_name],
-                    Key=self.counter_table_key,
-                    TableName=self.counter_table_name,
-                )
-            )
-            .get("Item", {})
-            .get(self.attribute_name)
+    def __post_init__(self):
+        super().__post_init__()
+        object.__setattr__(
+            self,
+            "_counter_get_kwargs",
+            {
+                "ExpressionAttributeNames": {"#counter": self.attribute_name},
+                "Key": self.counter_table_key,
+                "ProjectionExpression": "#counter",
+                "TableName": self.counter_table_name,
+            },
         )
 
+    def _cached_counter(self):
+        # Optimistically assume that the counter has not changed since our last
+        # put. If it has, then the transaction is cancelled, the cached value is
+        # discarded, and we read the counter on the next attempt.
+        return None if self.dangerously else self._last_counter
+
+    async def putmany(self, items: Iterable[DynamoDBItem]) -> list[Union[int, Decimal]]:
+        # Reserve a contiguous range of IDs for as many items as will fit in a
+        # single transaction alongside the counter update. Each transaction
+        # commits separately, so if one fails, then the items in the ones
+        # before it have already been put: report their IDs with the error.
+        ids: list[Union[int, Decimal]] = []
+        for chunk in self._chunks(items):
+            try:
+                ids.extend(await self._put(self.nextmany, chunk))
+            except Exception as e:
+                e.committed_ids = ids  # type: ignore[attr-defined]
+                raise
+        return ids
+
+    def _chunks(self, items):
+        counter_size = item_size({**self.counter_table_key, self.attribute_name: 0})
+        id_size = item_size({self.attribute_name: 0})
+        chunk = []
+        size = counter_size
+        for item in items:
+            next_size = id_size + item_size(item)
+            if chunk and (
+                len(chunk) + 1 >= MAX_TRANSACT_ITEMS
+                or size + next_size > MAX_TRANSACT_SIZE
+            ):
+                yield chunk
+                chunk = []
+                size = counter_size
+            chunk.append(item)
+            size += next_size
+        if chunk:
+            yield chunk
+
+    async def next(self, item, consistent=False):
+        puts, (next_counter,) = await self.nextmany([item], consistent)
+        return puts, next_counter
+
+    async def nextmany(self, items, consistent=False):
+        counter = None if consistent else self._cached_counter()
+        if counter is None:
+            counter = (
+                (await self._get_counter_item(consistent, **self._counter_get_kwargs))
+                .get("Item", {})
+                .get(self.attribute_name)
+            )
+
         if counter is None:
-            next_counter = self.initial_value
+            first_counter = self._initial_value
             put_kwargs = {"ConditionExpression": "attribute_not_exists(#counter)"}
         else:
-            next_counter = counter + 1
+            first_counter = counter + ONE
             put_kwargs = {
                 "ConditionExpression": "#counter = :counter",
                 "ExpressionAttributeValues": {
                     ":counter": counter,
                 },
             }
+        next_counters = [first_counter + i for i in range(len(items))]
 
-        puts = [
+        puts = (
             {
+                **self._counter_put_template,
                 **put_kwargs,
-                "ExpressionAttributeNames": {
-                    "#counter": self.attribute_name,
-                },
                 "Item": {
                     **self.counter_table_key,
-                    self.attribute_name: next_counter,
+                    self.attribute_name: next_counters[-1],
                 },
-                "TableName": self.counter_table_name,
             },
+            *(
+                {
+                    **self._data_put_template,
+                    "Item": {self.attribute_name: next_counter, **item},
+                }
+                for next_counter, item in zip(next_counters, items)
+            ),
+        )
+
+        return puts, next_counters
+
+
+@dataclass(frozen=True)
+class DynamoDBHistoryAutoIncrement(BaseDynamoDBAutoIncrement):
+    # How long get() may return a cached copy of the current item, in seconds.
+    # Puts through this instance always invalidate the cache.
+    head_cache_ttl: float = 0.0
+
+    # Set in __post_init__
+    _head_cache: Optional[tuple[float, int, Optional[DynamoDBItem]]] = field(
+        init=False, repr=False, compare=False
+    )
+    _generation: int = field(init=False, repr=False, compare=False)
+    _list_kwargs: dict[str, Any] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+        object.__setattr__(self, "_head_cache", None)
+        # Incremented by every put, so that a get() that read the item before a
+        # put finished does not cache it afterwards
+        object.__setattr__(self, "_generation", 0)
+        object.__setattr__(
+            self,
+            "_list_kwargs",
             {
-                "ConditionExpression": "attribute_not_exists(#counter)",
+                "TableName": self.table_name,
                 "ExpressionAttributeNames": {
+                    **{
+                        f"#{i}": key
+                        for i, key in enumerate(self.counter_table_key.keys())
+                    },
                     "#counter": self.attribute_name,
                 },
-                "Item": {self.attribute_name: next_counter, **item},
-                "TableName": self.table_name,
+                "ExpressionAttributeValues": {
+                    f":{i}": value
+                    for i, value in enumerate(self.counter_table_key.values())
+                },
+                "KeyConditionExpression": " AND ".join(
+                    f"#{i} = :{i}" for i in range(len(self.counter_table_key.keys()))
+                ),
+                "ProjectionExpression": "#counter",
+                "ScanIndexForward": True,
             },
-        ]
-
-        return puts, next_counter
-
+        )
 
-class DynamoDBHistoryAutoIncrement(BaseDynamoDBAutoIncrement):
     async def list(self) -> list[int]:
-        result = await self.dynamodb.query(  # type: ignore[attr-defined]
-            TableName=self.table_name,
-            ExpressionAttributeNames={
-                **{f"#{i}": key for i, key in enumerate(self.counter_table_key.keys())},
-                "#counter": self.attribute_name,
-            },
-            ExpressionAttributeValues={
-                f":{i}": value
-                for i, value in enumerate(self.counter_table_key.values())
-            },
-            KeyConditionExpression=" AND ".join(
-                f"#{i} = :{i}" for i in range(len(self.counter_table_key.keys()))
-            ),
-            ProjectionExpression="#counter",
-        )
-        return sorted(item[self.attribute_name] for item in result["Items"])
+        # The history table's sort key is the counter attribute, so the query
+        # returns the versions in order.
+        result = await self.dynamodb.query(**self._list_kwargs)  # type: ignore[attr-defined]
+        versions = [item[self.attribute_name] for item in result["Items"]]
+        while "LastEvaluatedKey" in result:
+            result = await self.dynamodb.query(  # type: ignore[attr-defined]
+                **self._list_kwargs,
+                ExclusiveStartKey=result["LastEvaluatedKey"],
+            )
+            versions.extend(item[self.attribute_name] for item in result["Items"])
+        return versions
 
-    async def get(self, version: Optional[int] = None) -> DynamoDBItem:
+    async def get(self, version: Optional[int] = None) -> Optional[DynamoDBItem]:
         if version is None:
+            now = time.monotonic()
+            generation = self._generation
+            if self._head_cache is not None:
+                timestamp, cached_generation, item = self._head_cache
+                if (
+                    cached_generation == generation
+                    and now - timestamp < self.head_cache_ttl
+                ):
+                    # Copy the item so that callers cannot change the cache
+                    return deepcopy(item)
             kwargs = {
                 "TableName": self.counter_table_name,
                 "Key": self.counter_table_key,
@@ -136,11 +445,26 @@ class DynamoDBHistoryAutoIncrement(BaseDynamoDBAutoIncrement):
                 "TableName": self.table_name,
                 "Key": {**self.counter_table_key, self.attribute_name: version},
             }
-        return (await self.dynamodb.get_item(**kwargs)).get("Item")  # type: ignore[attr-defined]
+        item = (await self.dynamodb.get_item(**kwargs)).get("Item")  # type: ignore[attr-defined]
+        if (
+            version is None
+            and self.head_cache_ttl > 0
+            and generation == self._generation
+        ):
+            object.__setattr__(self, "_head_cache", (now, generation, deepcopy(item)))
+        return item
+
+    async def put(self, item: DynamoDBItem):
+        try:
+            return await super().put(item)
+        finally:
+            object.__setattr__(self, "_generation", self._generation + 1)
+            object.__setattr__(self, "_head_cache", None)
 
-    async def next(self, item):
+    async def next(self, item, consistent=False):
         existing_item = (
-            await self.dynamodb.get_item(
+            await self._get_counter_item(
+                consistent,
                 TableName=self.counter_table_name,
                 Key=self.counter_table_key,
             )
@@ -151,10 +475,10 @@ class DynamoDBHistoryAutoIncrement(BaseDynamoDBAutoIncrement):
         )
 
         if counter is None:
-            next_counter = self.initial_value
+            next_counter = self._initial_value
             put_kwargs = {"ConditionExpression": "attribute_not_exists(#counter)"}
         else:
-            next_counter = counter + 1
+            next_counter = counter + ONE
             put_kwargs = {
                 "ConditionExpression": "#counter = :counter",
                 "ExpressionAttributeValues": {
@@ -164,33 +488,21 @@ class DynamoDBHistoryAutoIncrement(BaseDynamoDBAutoIncrement):
 
         if existing_item is not None and counter is None:
             existing_item[self.attribute_name] = next_counter
-            next_counter += 1
+            next_counter += ONE
 
-        puts = [
-            {
-                **put_kwargs,
-                "ExpressionAttributeNames": {
-                    "#counter": self.attribute_name,
-                },
-                "Item": {
-                    **item,
-                    **self.counter_table_key,
-                    self.attribute_name: next_counter,
-                },
-                "TableName": self.counter_table_name,
+        counter_put = {
+            **self._counter_put_template,
+            **put_kwargs,
+            "Item": {
+                **item,
+                **self.counter_table_key,
+                self.attribute_name: next_counter,
             },
-        ]
+        }
 
-        if existing_item is not None:
-            puts.append(
-                {
-                    "ConditionExpression": "attribute_not_exists(#counter)",
-                    "ExpressionAttributeNames": {
-                        "#counter": self.attribute_name,
-                    },
-                    "Item": existing_item,
-                    "TableName": self.table_name,
-                }
-            )
+        if existing_item is None:
+            puts = (counter_put,)
+        else:
+            puts = (counter_put, {**self._data_put_template, "Item": existing_item})
 
         return puts, next_counter
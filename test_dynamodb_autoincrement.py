@@ -2,54 +2,91 @@
 # Administrator of the National Aeronautics and Space Administration.
 # All Rights Reserved.
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, EndpointConnectionError
+import aioboto3
+from aiobotocore.awsrequest import AioAWSResponse
+from aiobotocore.config import AioConfig
 import asyncio
+from copy import deepcopy
+import json
+from dataclasses import replace
+from types import SimpleNamespace
 import pytest
 from pytest_asyncio import fixture as asyncio_fixture
 
-from dynamodb_autoincrement import DynamoDBAutoIncrement, DynamoDBHistoryAutoIncrement
+from dynamodb_autoincrement import (
+    DynamoDBAutoIncrement,
+    DynamoDBHistoryAutoIncrement,
+    backoff,
+    gather_or_cancel,
+    local_locks,
+)
 
 
 N = 20
 
 
+async def create_table(dynamodb, max_attempts=5, **kwargs):
+    # Creating many tables at once can be throttled, so back off and retry.
+    attempt = 0
+    while True:
+        try:
+            await dynamodb.create_table(**kwargs)
+        except ClientError as e:
+            attempt += 1
+            if (
+                e.response["Error"]["Code"] != "LimitExceededException"
+                or attempt >= max_attempts
+            ):
+                raise
+            # Use the same delays as puts do by default
+            await asyncio.sleep(
+                backoff(
+                    attempt,
+                    DynamoDBAutoIncrement.base_delay,
+                    DynamoDBAutoIncrement.max_delay,
+                )
+            )
+        else:
+            break
+    await dynamodb.meta.client.get_waiter("table_exists").wait(
+        TableName=kwargs["TableName"], WaiterConfig={"Delay": 1}
+    )
+
+
 @asyncio_fixture
 async def create_tables(asyncio_dynamodb):
-    await asyncio.gather(
-        *(
-            asyncio_dynamodb.create_table(**kwargs)
-            for kwargs in [
-                {
-                    "AttributeDefinitions": [
-                        {"AttributeName": "tableName", "AttributeType": "S"}
-                    ],
-                    "BillingMode": "PAY_PER_REQUEST",
-                    "KeySchema": [{"AttributeName": "tableName", "KeyType": "HASH"}],
-                    "TableName": "autoincrement",
-                },
-                {
-                    "BillingMode": "PAY_PER_REQUEST",
-                    "AttributeDefinitions": [
-                        {"AttributeName": "widgetID", "AttributeType": "N"}
-                    ],
-                    "KeySchema": [{"AttributeName": "widgetID", "KeyType": "HASH"}],
-                    "TableName": "widgets",
-                },
-                {
-                    "BillingMode": "PAY_PER_REQUEST",
-                    "AttributeDefinitions": [
-                        {"AttributeName": "widgetID", "AttributeType": "N"},
-                        {"AttributeName": "version", "AttributeType": "N"},
-                    ],
-                    "KeySchema": [
-                        {"AttributeName": "widgetID", "KeyType": "HASH"},
-                        {"AttributeName": "version", "KeyType": "RANGE"},
-                    ],
-                    "TableName": "widgetHistory",
-                },
-            ]
-        )
-    )
+    for kwargs in [
+        {
+            "AttributeDefinitions": [
+                {"AttributeName": "tableName", "AttributeType": "S"}
+            ],
+            "BillingMode": "PAY_PER_REQUEST",
+            "KeySchema": [{"AttributeName": "tableName", "KeyType": "HASH"}],
+            "TableName": "autoincrement",
+        },
+        {
+            "BillingMode": "PAY_PER_REQUEST",
+            "AttributeDefinitions": [
+                {"AttributeName": "widgetID", "AttributeType": "N"}
+            ],
+            "KeySchema": [{"AttributeName": "widgetID", "KeyType": "HASH"}],
+            "TableName": "widgets",
+        },
+        {
+            "BillingMode": "PAY_PER_REQUEST",
+            "AttributeDefinitions": [
+                {"AttributeName": "widgetID", "AttributeType": "N"},
+                {"AttributeName": "version", "AttributeType": "N"},
+            ],
+            "KeySchema": [
+                {"AttributeName": "widgetID", "KeyType": "HASH"},
+                {"AttributeName": "version", "KeyType": "RANGE"},
+            ],
+            "TableName": "widgetHistory",
+        },
+    ]:
+        await create_table(asyncio_dynamodb, **kwargs)
 
 
 @pytest.fixture
@@ -74,6 +111,7 @@ def autoincrement_dangerously(asyncio_dynamodb, create_tables):
         initial_value=1,
         dynamodb=asyncio_dynamodb,
         dangerously=True,
+        local_serialize=False,
     )
 
 
@@ -91,6 +129,158 @@ def autoincrement_version(asyncio_dynamodb, create_tables):
     )
 
 
+def fake_session():
+    return aioboto3.Session(
+        aws_access_key_id="fake",
+        aws_secret_access_key="fake",
+        region_name="us-east-1",
+    )
+
+
+class FakeDynamoDB:
+    # Just enough of a DynamoDB service resource to run the autoincrement
+    # classes without a DynamoDB server. Conditions are not checked.
+    meta = SimpleNamespace(
+        client=SimpleNamespace(
+            exceptions=SimpleNamespace(TransactionCanceledException=ClientError)
+        )
+    )
+
+    def __init__(self, key_schema={}, page_size=2):
+        self.key_schema = key_schema
+        self.tables = {table_name: {} for table_name in key_schema}
+        # If set, get_item reads the item and then waits for this event
+        self.paused = None
+        # The most items that query returns at once
+        self.page_size = page_size
+
+    def key(self, table_name, item):
+        return tuple(item[name] for name in self.key_schema[table_name])
+
+    async def get_item(self, TableName, Key, **kwargs):
+        paused = self.paused
+        item = self.tables[TableName].get(self.key(TableName, Key))
+        if paused is not None:
+            await paused.wait()
+        return {} if item is None else {"Item": deepcopy(item)}
+
+    async def query(self, TableName, ExclusiveStartKey=None, **kwargs):
+        # Return every item in the table in key order, a page at a time
+        keys = sorted(self.tables[TableName])
+        if ExclusiveStartKey is not None:
+            start = self.key(TableName, ExclusiveStartKey)
+            keys = [key for key in keys if key > start]
+        result = {
+            "Items": [
+                deepcopy(self.tables[TableName][key]) for key in keys[: self.page_size]
+            ]
+        }
+        if len(keys) > self.page_size:
+            result["LastEvaluatedKey"] = dict(
+                zip(self.key_schema[TableName], keys[self.page_size - 1])
+            )
+        return result
+
+    async def transact_write_items(self, TransactItems, **kwargs):
+        for action in TransactItems:
+            table_name = action["Put"]["TableName"]
+            item = deepcopy(action["Put"]["Item"])
+            self.tables[table_name][self.key(table_name, item)] = item
+
+
+@pytest.mark.parametrize(
+    "config,max_pool_connections,connector_args",
+    [
+        (None, 64, {"keepalive_timeout": 75}),
+        (AioConfig(max_pool_connections=128), 128, {"keepalive_timeout": 75}),
+        (
+            AioConfig(connector_args={"keepalive_timeout": 5}),
+            64,
+            {"keepalive_timeout": 5},
+        ),
+    ],
+)
+@pytest.mark.asyncio
+async def test_make_resource(config, max_pool_connections, connector_args):
+    async with DynamoDBAutoIncrement.make_resource(fake_session(), config) as dynamodb:
+        client_config = dynamodb.meta.client.meta.config
+    assert client_config.max_pool_connections == max_pool_connections
+    assert client_config.connector_args == connector_args
+    assert client_config.tcp_keepalive
+    assert client_config.retries["mode"] == "adaptive"
+
+
+class FakeRawResponse:
+    def __init__(self, body):
+        self.body = body
+
+    async def read(self):
+        return self.body
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_resends_same_token_after_connection_error():
+    requests = []
+
+    def before_send(request, **kwargs):
+        # Fail to connect the first time that we send the transaction, and
+        # reply with an empty response to everything else.
+        operation = request.headers["X-Amz-Target"].decode().split(".")[-1]
+        requests.append((operation, json.loads(request.body)))
+        if [op for op, _ in requests] == ["GetItem", "TransactWriteItems"]:
+            raise EndpointConnectionError(endpoint_url=request.url)
+        return AioAWSResponse(request.url, 200, {}, FakeRawResponse(b"{}"))
+
+    async with fake_session().resource(
+        "dynamodb", endpoint_url="http://localhost:1"
+    ) as dynamodb:
+        dynamodb.meta.client.meta.events.register("before-send.dynamodb", before_send)
+        autoincrement = DynamoDBAutoIncrement(
+            counter_table_name="autoincrement",
+            counter_table_key={"tableName": "widgets"},
+            table_name="widgets",
+            attribute_name="widgetID",
+            initial_value=1,
+            dynamodb=dynamodb,
+        )
+        assert await autoincrement.put({}) == 1
+
+    operations, bodies = zip(*requests)
+    assert operations == ("GetItem", "TransactWriteItems", "TransactWriteItems")
+    assert bodies[1]["ClientRequestToken"] == bodies[2]["ClientRequestToken"]
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_subclass_without_consistent_argument():
+    class LegacyAutoIncrement(DynamoDBAutoIncrement):
+        async def next(self, item):
+            return await super().next(item)
+
+    dynamodb = FakeDynamoDB({"autoincrement": ["tableName"], "widgets": ["widgetID"]})
+    transact_write_items = dynamodb.transact_write_items
+
+    async def conflict_once(**kwargs):
+        dynamodb.transact_write_items = transact_write_items
+        raise ClientError(
+            {
+                "Error": {"Code": "TransactionCanceledException"},
+                "CancellationReasons": [{"Code": "ConditionalCheckFailed"}],
+            },
+            "TransactWriteItems",
+        )
+
+    dynamodb.transact_write_items = conflict_once
+    autoincrement = LegacyAutoIncrement(
+        counter_table_name="autoincrement",
+        counter_table_key={"tableName": "widgets"},
+        table_name="widgets",
+        attribute_name="widgetID",
+        initial_value=1,
+        dynamodb=dynamodb,
+    )
+    assert await autoincrement.put({}) == 1
+
+
 @pytest.mark.parametrize("last_id", [None, 1, 2, 3])
 @pytest.mark.asyncio
 async def test_autoincrement_safely(autoincrement_safely, asyncio_dynamodb, last_id):
@@ -118,15 +308,134 @@ async def test_autoincrement_safely(autoincrement_safely, asyncio_dynamodb, last
     ]
 
 
+@pytest.mark.parametrize("local_serialize", [True, False])
+@pytest.mark.asyncio
+async def test_autoincrement_safely_handles_many_parallel_puts(
+    autoincrement_safely, local_serialize
+):
+    autoincrement = replace(autoincrement_safely, local_serialize=local_serialize)
+    ids = list(range(1, N + 1))
+    result = sorted(await asyncio.gather(*(autoincrement.put({}) for _ in range(N))))
+    assert result == ids
+
+
 @pytest.mark.asyncio
-async def test_autoincrement_safely_handles_many_parallel_puts(autoincrement_safely):
+async def test_autoincrement_safely_shares_lock_between_instances(
+    autoincrement_safely,
+):
+    # Without a shared lock, these would contend for the counter and run out
+    # of attempts.
+    autoincrements = [replace(autoincrement_safely, max_attempts=1) for _ in range(2)]
     ids = list(range(1, N + 1))
     result = sorted(
-        await asyncio.gather(*(autoincrement_safely.put({}) for _ in range(N)))
+        await asyncio.gather(*(autoincrements[i % 2].put({}) for i in range(N)))
     )
     assert result == ids
 
 
+@pytest.mark.asyncio
+async def test_autoincrement_releases_unused_lock():
+    dynamodb = FakeDynamoDB(
+        {"widgets": ["widgetID"], "widgetHistory": ["widgetID", "version"]}
+    )
+    for widget_id in range(N):
+        autoincrement = DynamoDBHistoryAutoIncrement(
+            dynamodb=dynamodb,
+            counter_table_name="widgets",
+            counter_table_key={"widgetID": widget_id},
+            attribute_name="version",
+            table_name="widgetHistory",
+            initial_value=1,
+        )
+
+        # Hold a put while it has the lock.
+        resume = dynamodb.paused = asyncio.Event()
+        put = asyncio.ensure_future(autoincrement.put({}))
+        await asyncio.sleep(0)
+        dynamodb.paused = None
+        assert len(local_locks[asyncio.get_running_loop()]) == 1
+
+        resume.set()
+        assert await put == 1
+        assert len(local_locks[asyncio.get_running_loop()]) == 0
+
+
+@pytest.mark.parametrize("count", [0, 1, N, 150])
+@pytest.mark.asyncio
+async def test_autoincrement_safely_putmany(
+    autoincrement_safely, asyncio_dynamodb, count
+):
+    await autoincrement_safely.put({})
+    ids = list(range(2, count + 2))
+    assert await autoincrement_safely.putmany({} for _ in range(count)) == ids
+
+    items = (await asyncio_dynamodb.scan(TableName="widgets"))["Items"]
+    assert sorted(item["widgetID"] for item in items) == [1, *ids]
+
+
+@pytest.mark.parametrize(
+    "items,chunk_sizes",
+    [
+        ([{}] * 150, [99, 51]),
+        ([{"description": "x" * 300_000}] * 20, [13, 7]),
+    ],
+)
+def test_autoincrement_putmany_splits_transactions(items, chunk_sizes):
+    autoincrement = DynamoDBAutoIncrement(
+        counter_table_name="autoincrement",
+        counter_table_key={"tableName": "widgets"},
+        table_name="widgets",
+        attribute_name="widgetID",
+        initial_value=1,
+        dynamodb=FakeDynamoDB(),
+    )
+    assert [len(chunk) for chunk in autoincrement._chunks(items)] == chunk_sizes
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_safely_putmany_reports_committed_ids(
+    autoincrement_safely, asyncio_dynamodb
+):
+    # The second transaction (IDs 100 to 150) fails because ID 120 is taken.
+    await asyncio_dynamodb.put_item(TableName="widgets", Item={"widgetID": 120})
+    with pytest.raises(ClientError, match="ConditionalCheckFailed") as excinfo:
+        await autoincrement_safely.putmany({} for _ in range(150))
+    assert excinfo.value.committed_ids == list(range(1, 100))
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_safely_detects_stale_counter(
+    autoincrement_safely, asyncio_dynamodb
+):
+    # A stale cached counter is not contention, so it must not use up attempts.
+    autoincrement = replace(autoincrement_safely, max_attempts=1)
+    assert await autoincrement.put({}) == 1
+    await asyncio_dynamodb.put_item(
+        TableName="autoincrement",
+        Item={"tableName": "widgets", "widgetID": 5},
+    )
+    assert await autoincrement.put({}) == 6
+    assert await autoincrement.put({}) == 7
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_safely_gives_up_after_max_attempts(autoincrement_safely):
+    autoincrement = replace(autoincrement_safely, max_attempts=1, local_serialize=False)
+    with pytest.raises(ClientError, match="Transaction cancelled"):
+        await asyncio.gather(*(autoincrement.put({}) for _ in range(N)))
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_safely_does_not_retry_if_id_is_taken(
+    autoincrement_safely, asyncio_dynamodb
+):
+    await asyncio_dynamodb.put_item(TableName="widgets", Item={"widgetID": 1})
+    # Retrying would almost certainly sleep for longer than the timeout.
+    autoincrement = replace(autoincrement_safely, base_delay=3600, max_delay=3600)
+    with pytest.raises(ClientError, match="ConditionalCheckFailed"):
+        await asyncio.wait_for(autoincrement.put({}), 60)
+
+
 @pytest.mark.asyncio
 async def test_autoincrement_safely_raises_error_for_unhandled_dynamodb_exceptions(
     autoincrement_safely,
@@ -159,6 +468,108 @@ async def test_autoincrement_dangerously_fails_on_many_parallel_puts(
         await asyncio.gather(*(autoincrement_dangerously.put({}) for _ in range(N)))
 
 
+@pytest.mark.asyncio
+async def test_gather_or_cancel():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError, match="failed") as excinfo:
+        await asyncio.wait_for(gather_or_cancel(slow(), fail()), 5)
+    # The original exception, not an ExceptionGroup
+    assert type(excinfo.value) is ValueError
+    assert cancelled == [True]
+
+    async def value(x):
+        return x
+
+    assert await gather_or_cancel(value(1), value(2)) == [1, 2]
+
+
+class StaleReadDynamoDB:
+    # A read-through cache in front of DynamoDB whose entries never expire
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+        self.response = None
+        self.reads = 0
+
+    async def get_item(self, **kwargs):
+        self.reads += 1
+        if self.response is None:
+            self.response = await self.dynamodb.get_item(**kwargs)
+        return deepcopy(self.response)
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_safely_with_stale_read_dynamodb(
+    autoincrement_safely, asyncio_dynamodb
+):
+    read_dynamodb = StaleReadDynamoDB(asyncio_dynamodb)
+    autoincrement = replace(
+        autoincrement_safely, read_dynamodb=read_dynamodb, max_attempts=1
+    )
+    assert [await autoincrement.put({}) for _ in range(N)] == list(range(1, N + 1))
+    assert read_dynamodb.reads == 1
+
+    # Another writer leaves both our cached counter and the cache out of date.
+    await asyncio_dynamodb.put_item(
+        TableName="autoincrement",
+        Item={"tableName": "widgets", "widgetID": 100},
+    )
+    assert await autoincrement.put({}) == 101
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_version_with_stale_read_dynamodb(
+    autoincrement_version, asyncio_dynamodb
+):
+    read_dynamodb = StaleReadDynamoDB(asyncio_dynamodb)
+    autoincrement = replace(
+        autoincrement_version, read_dynamodb=read_dynamodb, max_attempts=1
+    )
+    assert [await autoincrement.put({}) for _ in range(N)] == list(range(1, N + 1))
+    assert read_dynamodb.reads == N
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_version_does_not_cache_item_read_before_put():
+    dynamodb = FakeDynamoDB(
+        {"widgets": ["widgetID"], "widgetHistory": ["widgetID", "version"]}
+    )
+    autoincrement = DynamoDBHistoryAutoIncrement(
+        dynamodb=dynamodb,
+        counter_table_name="widgets",
+        counter_table_key={"widgetID": 1},
+        attribute_name="version",
+        table_name="widgetHistory",
+        initial_value=1,
+        head_cache_ttl=60,
+    )
+
+    # Start a get() that reads the item before a put() but returns after it.
+    resume = dynamodb.paused = asyncio.Event()
+    get = asyncio.ensure_future(autoincrement.get())
+    await asyncio.sleep(0)
+    dynamodb.paused = None
+    assert await autoincrement.put({"name": "Handy Widget"}) == 1
+    resume.set()
+    assert await get is None
+
+    assert await autoincrement.get() == {
+        "widgetID": 1,
+        "name": "Handy Widget",
+        "version": 1,
+    }
+
+
 @asyncio_fixture(params=[None, {"widgetID": 1}, {"widgetID": 1, "version": 1}])
 async def initial_item(request, create_tables, asyncio_dynamodb):
     if request.param is not None:
@@ -199,19 +610,58 @@ async def test_autoincrement_version(
     assert await autoincrement_version.list() == list(range(1, len(history_items) + 1))
 
 
+@pytest.mark.asyncio
+async def test_autoincrement_version_lists_many_pages():
+    dynamodb = FakeDynamoDB(
+        {"widgets": ["widgetID"], "widgetHistory": ["widgetID", "version"]}
+    )
+    autoincrement = DynamoDBHistoryAutoIncrement(
+        dynamodb=dynamodb,
+        counter_table_name="widgets",
+        counter_table_key={"widgetID": 1},
+        attribute_name="version",
+        table_name="widgetHistory",
+        initial_value=1,
+    )
+    for _ in range(N):
+        await autoincrement.put({})
+    assert await autoincrement.list() == list(range(1, N))
+
+
+@pytest.mark.parametrize("local_serialize", [True, False])
 @pytest.mark.parametrize("tracked_attribute_value", [None, 42])
 @pytest.mark.asyncio
 async def test_autoincrement_version_handles_many_serial_puts(
-    autoincrement_version, initial_item, tracked_attribute_value
+    autoincrement_version, initial_item, tracked_attribute_value, local_serialize
 ):
+    autoincrement = replace(autoincrement_version, local_serialize=local_serialize)
     has_initial_item = initial_item is not None
     versions = list(range(1 + has_initial_item, N + has_initial_item + 1))
     result = sorted(
         await asyncio.gather(
-            *(
-                autoincrement_version.put({"version": tracked_attribute_value})
-                for _ in range(N)
-            )
+            *(autoincrement.put({"version": tracked_attribute_value}) for _ in range(N))
         )
     )
     assert result == versions
+
+
+@pytest.mark.asyncio
+async def test_autoincrement_version_caches_current_item(
+    autoincrement_version, asyncio_dynamodb
+):
+    autoincrement = replace(autoincrement_version, head_cache_ttl=60)
+    assert await autoincrement.get() is None
+
+    await asyncio_dynamodb.put_item(TableName="widgets", Item={"widgetID": 1})
+    assert await autoincrement.get() is None
+
+    await autoincrement.put({"name": "Handy Widget"})
+    item = {"widgetID": 1, "name": "Handy Widget", "version": 2}
+    assert await autoincrement.get() == item
+
+    # Changing a returned item does not change the cached item.
+    for _ in range(2):
+        result = await autoincrement.get()
+        assert result == item
+        result["name"] = "Mutated Widget"
+    assert await autoincrement.get() == item